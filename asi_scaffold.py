@@ -2,10 +2,25 @@
 
 import os
 import json
+import shutil
+import signal
+import sqlite3
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 import argparse
-from typing import Dict, Any, List
+import asyncio
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict, Any, List, Optional, Tuple, Union
+
+if sys.version_info < (3, 8):
+    print("Python 3.8 or newer is required (msgspec and orjson no longer support older versions).")
+    sys.exit(1)
 
 try:
     import requests
@@ -13,11 +28,75 @@ except ImportError:
     print("The 'requests' library is not installed. Please run 'pip install requests'.")
     sys.exit(1)
 
+try:
+    import msgspec
+except ImportError:
+    print("The 'msgspec' library is not installed. Please run 'pip install msgspec'.")
+    sys.exit(1)
+
+try:
+    import orjson
+except ImportError:
+    print("The 'orjson' library is not installed. Please run 'pip install orjson'.")
+    sys.exit(1)
+
+try:
+    import httpx  # Optional: only needed by the ask_llm_batch tool
+except ImportError:
+    httpx = None
+
+try:
+    import tiktoken  # Optional: more accurate token counts for history trimming
+except ImportError:
+    tiktoken = None
+
 # --- Configuration ---
-STATE_FILE = "agent_state.json"
-LLM_API_URL = "http://localhost:11434/api/generate"  # Ollama default
+STATE_DB = "agent_state.db" # SQLite database (WAL mode) holding the goal and one row per history entry
+LLM_API_URL = "http://localhost:11434/api/chat"  # Ollama default (chat endpoint)
+VLLM_API_URL = "http://localhost:8000/v1/chat/completions"  # vLLM OpenAI-compatible server, used with LLM_BACKEND=vllm
 LLM_MODEL = "mistral" # The model you have pulled in Ollama
-CONTEXT_WINDOW_TOKEN_LIMIT = 4096 # Conservative token limit for history
+CONTEXT_WINDOW_TOKEN_LIMIT = 3500 # Conservative token limit for history
+MESSAGE_TOKEN_OVERHEAD = 4 # Approximate per-message tokens for chat role framing
+# Ollama context window used for every call. It is fixed because changing num_ctx makes Ollama reload
+# the model; 8192 covers the system prompt, CONTEXT_WINDOW_TOKEN_LIMIT of history, and the reply.
+OLLAMA_NUM_CTX = 8192
+# Cap on generated tokens per call. Replies are small JSON objects, so this bounds decode time;
+# if "did not return valid JSON" errors show truncated replies, raise LLM_MAX_TOKENS.
+LLM_MAX_TOKENS = int(os.environ.get("LLM_MAX_TOKENS", 512))
+SUMMARY_TOKEN_BUDGET = 1000 # Token budget for history summaries; past it they are merged into one
+LLM_BATCH_LIMIT = 8 # Maximum number of questions ask_llm_batch sends at once
+COMPACT_BATCH_SIZE = 10 # Oldest history entries folded into one summary when the history overflows
+
+SUMMARY_PROMPT = """Summarize the following steps taken by an autonomous agent in at most 300 tokens.
+Keep the overall plan, key findings, and any unresolved errors. Respond with a JSON object of the form {{"summary": "..."}}.
+
+Steps:
+{steps}
+"""
+
+# Shared session so the connection to the LLM server is kept alive across turns.
+_SESSION = requests.Session()
+_SESSION.mount("http://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=4))
+
+# --- Token Counting ---
+
+def _approx_tokens(text: str) -> int:
+    """Cheap token count estimate (about four characters per token)."""
+    return len(text) // 4
+
+_TOKENIZER = None
+if tiktoken is not None:
+    try:
+        _TOKENIZER = tiktoken.get_encoding("cl100k_base")
+    except Exception:
+        # The encoding is downloaded on first use, which fails on an offline machine.
+        _TOKENIZER = None
+
+def count_tokens(text: str) -> int:
+    """Counts tokens with tiktoken if available, otherwise falls back to the cheap estimate."""
+    if _TOKENIZER is None:
+        return _approx_tokens(text)
+    return len(_TOKENIZER.encode(text, disallowed_special=()))
 
 # --- System Prompt: The Core Instructions for the LLM ---
 SYSTEM_PROMPT = """
@@ -52,15 +131,57 @@ Begin. Your first action is crucial. Analyze your goal and your available tools.
 
 # --- Tool Definitions ---
 
-def execute_shell(command: str) -> str:
-    """Executes a command in the system's shell."""
+def execute_shell(command: str, timeout: int = 60) -> str:
+    """Executes a command in the system's shell, killing it after `timeout` seconds."""
     try:
-        result = subprocess.run(
-            command, shell=True, text=True, capture_output=True, check=False
+        timeout = int(timeout)
+    except (TypeError, ValueError):
+        return "Error: 'timeout' must be an integer number of seconds."
+    try:
+        process = subprocess.Popen(
+            command, shell=True, text=True, errors="replace",
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            start_new_session=(os.name == "posix")
         )
-        output = f"STDOUT:\n{result.stdout}\nSTDERR:\n{result.stderr}"
-        if len(output) > 2000:
-            return f"Output truncated:\n{output[:2000]}"
+        # Only the last 2000 characters of each stream are kept, however much the command prints.
+        buffers = [deque(maxlen=2000), deque(maxlen=2000)]
+        totals = [0, 0]
+
+        def drain(index: int, stream) -> None:
+            for chunk in iter(lambda: stream.read(4096), ""):
+                buffers[index].extend(chunk)
+                totals[index] += len(chunk)
+            stream.close()
+
+        readers = [
+            threading.Thread(target=drain, args=(i, stream), daemon=True)
+            for i, stream in enumerate((process.stdout, process.stderr))
+        ]
+        for reader in readers:
+            reader.start()
+
+        timed_out = False
+        try:
+            process.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            timed_out = True
+        finally:
+            # Runs on timeout and on anything else (e.g. Ctrl+C, which the child's own session doesn't receive).
+            if process.poll() is None:
+                # Kill the whole process group so children of the shell don't keep the pipes open.
+                if os.name == "posix":
+                    os.killpg(process.pid, signal.SIGKILL)
+                else:
+                    process.kill()
+                process.wait()
+        for reader in readers:
+            reader.join(timeout=5)
+
+        output = f"STDOUT:\n{''.join(buffers[0])}\nSTDERR:\n{''.join(buffers[1])}"
+        if max(totals) > 2000:
+            output = f"Output truncated (last 2000 characters of each stream):\n{output}"
+        if timed_out:
+            output = f"Command timed out after {timeout} seconds and was killed.\n{output}"
         return output
     except Exception as e:
         return f"Error executing shell command: {e}"
@@ -68,29 +189,61 @@ def execute_shell(command: str) -> str:
 def read_file(path: str) -> str:
     """Reads the content of a file."""
     try:
+        # Read only what can be returned, plus one character to tell whether there is more.
         with open(path, 'r', encoding='utf-8') as f:
-            content = f.read()
-        if len(content) > 2000:
-            return f"Content truncated:\n{content[:2000]}"
+            content = f.read(2000)
+            truncated = bool(f.read(1))
+        if truncated:
+            return f"Content truncated:\n{content}"
         return content
     except Exception as e:
         return f"Error reading file: {e}"
 
+def _atomic_write(path: str, data: bytes):
+    """Writes data to a temporary sibling file and swaps it into place, so readers never see a partial file."""
+    # Write through symlinks, and keep the target's permissions (e.g. the executable bit on scripts).
+    target = os.path.realpath(path)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(target), prefix=f".{os.path.basename(target)}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        if os.path.exists(target):
+            shutil.copymode(target, tmp)
+        else:
+            # mkstemp creates files as 0600; give new files the usual umask-based mode instead.
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmp, 0o666 & ~umask)
+        os.replace(tmp, target)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
 def write_file(path: str, content: str) -> str:
     """Writes content to a file, overwriting it if it exists."""
     try:
-        os.makedirs(os.path.dirname(path), exist_ok=True)
-        with open(path, 'w', encoding='utf-8') as f:
-            f.write(content)
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        _atomic_write(path, content.encode('utf-8'))
         return f"Successfully wrote to {path}."
     except Exception as e:
         return f"Error writing file: {e}"
 
 def list_directory(path: str) -> str:
-    """Lists the contents of a directory."""
+    """Lists the contents of a directory (at most 500 entries)."""
     try:
-        files = os.listdir(path)
-        return json.dumps(files)
+        files = []
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if len(files) == 500:
+                    files.append("...")
+                    break
+                files.append(entry.name)
+        return orjson.dumps(files).decode()
     except Exception as e:
         return f"Error listing directory: {e}"
 
@@ -101,18 +254,95 @@ def ask_llm(question: str, model: str = LLM_MODEL) -> str:
         # This is a simplified, non-conversational query
         # Note: This tool still calls the API directly, even in manual mode.
         # This is often desired, as you might want the agent to use its own sub-tasks automatically.
-        response_text = query_llm(question, model=model, history=[])
+        response_text = query_llm([{"role": "user", "content": question}], model=model)
         print(f"<< LLM Response: {response_text}")
         return response_text
     except Exception as e:
         return f"Error querying LLM: {e}"
 
+async def _gather(questions: List[str], model: str) -> List[Any]:
+    """Runs all questions concurrently over one shared client; failed questions yield their exception."""
+    async with httpx.AsyncClient(timeout=300) as client:
+        return await asyncio.gather(*(
+            _BACKEND.agenerate(client, [{"role": "user", "content": q}], model) for q in questions
+        ), return_exceptions=True)
+
+def ask_llm_batch(questions: List[str], model: str = LLM_MODEL) -> str:
+    """Asks several independent questions to an LLM concurrently and returns the answers as a JSON list."""
+    # The server only overlaps these requests if OLLAMA_NUM_PARALLEL is at least len(questions).
+    if httpx is None:
+        return "Error: The 'httpx' library is not installed. Please run 'pip install httpx'."
+    if not isinstance(questions, list) or not all(isinstance(q, str) for q in questions):
+        return "Error: 'questions' must be a list of strings."
+    if not questions or len(questions) > LLM_BATCH_LIMIT:
+        return f"Error: 'questions' must contain between 1 and {LLM_BATCH_LIMIT} questions."
+    print(f"\n>> Delegating {len(questions)} questions to LLM (Model: {model})")
+    try:
+        results = asyncio.run(_gather(questions, model))
+        # One failed sub-query should not discard the other answers.
+        answers = [
+            f"Error querying LLM: {r}" if isinstance(r, Exception) else r
+            for r in results
+        ]
+        print(f"<< LLM Responses: {answers}")
+        return orjson.dumps(answers).decode()
+    except Exception as e:
+        return f"Error querying LLM: {e}"
+
 def finish(result: str) -> str:
     """Signals that the main goal has been achieved."""
     print(f"--- AGENT FINISHED ---")
     print(f"Final Result: {result}")
     sys.exit(0)
 
+TOOLS = {
+    "execute_shell": execute_shell,
+    "read_file": read_file,
+    "write_file": write_file,
+    "list_directory": list_directory,
+    "ask_llm": ask_llm,
+    "ask_llm_batch": ask_llm_batch,
+    "finish": finish,
+}
+
+def _annotation_name(annotation: Any) -> str:
+    """Renders a type annotation for the prompt, e.g. 'str' or 'List[str]'."""
+    # Generics like List[str] have no __name__ before Python 3.10, and after it the name drops the arguments.
+    if getattr(annotation, "__args__", None):
+        return str(annotation).replace("typing.", "")
+    return getattr(annotation, "__name__", None) or str(annotation).replace("typing.", "")
+
+# Tool descriptions depend only on the functions themselves, so they are built once at import.
+# Type objects in the annotations are converted to their string names before serializing.
+TOOLS_SPEC = {
+    name: f'- `{name}`: {func.__doc__}\n  Args: {orjson.dumps({k: _annotation_name(v) for k, v in func.__annotations__.items()}).decode()}'
+    for name, func in TOOLS.items()
+}
+
+
+# --- History Entries ---
+
+class CommandSpec(msgspec.Struct):
+    """The command an LLM response asked for."""
+    name: Optional[str] = None
+    args: Dict[str, Any] = {}
+
+class HistoryEntry(msgspec.Struct, tag="step"):
+    """One loop iteration: the LLM's reasoning, its command, and the command's result."""
+    thoughts: str
+    command: CommandSpec
+    result: str
+
+class ErrorEntry(msgspec.Struct, tag="error"):
+    """An iteration that failed before a command could run."""
+    error: str
+
+class SummaryEntry(msgspec.Struct, tag="summary"):
+    """A compacted summary of older history entries."""
+    content: str
+
+HistoryItem = Union[HistoryEntry, ErrorEntry, SummaryEntry]
+
 
 # --- Core Agent Logic ---
 
@@ -121,64 +351,242 @@ class Agent:
     def __init__(self, main_goal: str, manual_mode: bool = False):
         self.main_goal = main_goal
         self.manual_mode = manual_mode # <--- ADDED
-        self.tools = {
-            "execute_shell": execute_shell,
-            "read_file": read_file,
-            "write_file": write_file,
-            "list_directory": list_directory,
-            "ask_llm": ask_llm,
-            "finish": finish,
+        self.tools = TOOLS
+        # The tool table never changes, so the prompt prefix is built once.
+        self._tools_description = "\n".join(TOOLS_SPEC.values())
+        self._system_prompt_prefix = SYSTEM_PROMPT.format(
+            main_goal=self.main_goal,
+            tools_description=self._tools_description
+        )
+        # Chat templates expect a user turn before the first reply (Mistral's renders the system
+        # prompt inside it), so every conversation opens with this fixed request.
+        self._opening_message = {
+            "role": "user",
+            "content": f"**Your Goal:** {self.main_goal}\n\nBegin. Respond with your next action as a single JSON object."
         }
+        self._encoder = msgspec.msgpack.Encoder()
+        self._hist_decoder = msgspec.msgpack.Decoder(HistoryItem)
+        self._db = self._open_state_db()
         self.state = self._load_state()
+        # Number of history entries already written to the database.
+        self._saved_count = len(self.state["history"])
+        self._rebuild_caches()
+
+        if not self.manual_mode and isinstance(_BACKEND, OllamaBackend):
+            # These are read by the Ollama server, so this only reflects it if it was started from this shell.
+            num_parallel = os.environ.get("OLLAMA_NUM_PARALLEL")
+            max_loaded = os.environ.get("OLLAMA_MAX_LOADED_MODELS")
+            print(f"OLLAMA_NUM_PARALLEL={num_parallel or 'unset'}, OLLAMA_MAX_LOADED_MODELS={max_loaded or 'unset'}")
+            if not num_parallel:
+                print("Advisory: start 'ollama serve' with OLLAMA_NUM_PARALLEL set (e.g. 4) so ask_llm_batch requests run concurrently.")
+
+    def _open_state_db(self) -> sqlite3.Connection:
+        """Opens the state database in WAL mode, creating its tables if needed."""
+        db = sqlite3.connect(STATE_DB, isolation_level=None)
+        # WAL makes each save an O(entry) append; NORMAL sync is safe in WAL mode and avoids an fsync per commit.
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute("CREATE TABLE IF NOT EXISTS history (id INTEGER PRIMARY KEY, ts REAL, entry BLOB)")
+        db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        return db
+
+    @contextmanager
+    def _transaction(self):
+        """Runs the enclosed statements in one transaction, rolling back if anything (even Ctrl+C) interrupts it."""
+        self._db.execute("BEGIN")
+        try:
+            yield
+            self._db.execute("COMMIT")
+        except BaseException:
+            # SQLite rolls back by itself on some errors (e.g. SQLITE_FULL); a second ROLLBACK would hide the real one.
+            if self._db.in_transaction:
+                self._db.execute("ROLLBACK")
+            raise
 
     def _load_state(self) -> Dict[str, Any]:
-        """Loads agent state from file or initializes a new one."""
-        if os.path.exists(STATE_FILE):
-            print(f"Loading state from {STATE_FILE}...")
-            with open(STATE_FILE, 'r') as f:
-                return json.load(f)
+        """Loads agent state from the database or initializes a new one."""
+        row = self._db.execute("SELECT value FROM meta WHERE key = 'main_goal'").fetchone()
+        if row is not None:
+            print(f"Loading state from {STATE_DB}...")
+            history = [
+                self._hist_decoder.decode(entry)
+                for (entry,) in self._db.execute("SELECT entry FROM history ORDER BY id")
+            ]
+            return {
+                "main_goal": row[0],
+                "history": history,
+            }
         else:
             print("No state file found. Initializing new state.")
+            self._db.execute("INSERT INTO meta (key, value) VALUES ('main_goal', ?)", (self.main_goal,))
             return {
                 "main_goal": self.main_goal,
                 "history": [],
             }
 
     def _save_state(self):
-        """Saves the current state to file."""
-        with open(STATE_FILE, 'w') as f:
-            json.dump(self.state, f, indent=4)
-
-    def _get_tools_description(self) -> str:
-        """Generates a string describing available tools for the prompt."""
-        # The fix is to convert the type objects in the annotations to their string names
-        # before passing them to json.dumps.
-        return "\n".join(
-            f'- `{name}`: {func.__doc__}\n  Args: {json.dumps({k: v.__name__ for k, v in func.__annotations__.items()})}'
-            for name, func in self.tools.items()
-        )
+        """Inserts history entries not yet persisted into the database."""
+        history = self.state["history"]
+        if self._saved_count >= len(history):
+            return
+        now = time.time()
+        with self._transaction():
+            self._db.executemany(
+                "INSERT INTO history (ts, entry) VALUES (?, ?)",
+                ((now, self._encoder.encode(entry)) for entry in history[self._saved_count:])
+            )
+        # Only reached once the transaction has committed, so a failed save is retried next time.
+        self._saved_count = len(history)
+
+    def _rewrite_state(self, history: List[HistoryItem]):
+        """Replaces all stored history with `history`; only needed when existing entries change, e.g. after compaction."""
+        # The caller adopts `history` as self.state["history"] only after this returns, so a failure
+        # leaves memory and the database in step.
+        now = time.time()
+        with self._transaction():
+            self._db.execute("DELETE FROM history")
+            self._db.executemany(
+                "INSERT INTO history (ts, entry) VALUES (?, ?)",
+                ((now, self._encoder.encode(entry)) for entry in history)
+            )
+        # Only reached once the transaction has committed.
+        self._saved_count = len(history)
+
+    def _rebuild_caches(self):
+        """Recomputes the per-entry caches from scratch, e.g. after loading or compacting the history."""
+        # Kept parallel to the history so each entry is serialized only once: its JSON text,
+        # its chat messages, and running token totals (_token_prefix[i] covers history[:i]).
+        self._history_json_cache = []
+        self._history_messages_cache = []
+        self._token_prefix = [0]
+        for entry in self.state["history"]:
+            self._cache_entry(entry)
+
+    def _cache_entry(self, entry: HistoryItem):
+        """Serializes a new entry and extends the caches with it."""
+        entry_json = msgspec.json.encode(entry).decode()
+        messages = self._entry_messages(entry)
+        self._history_json_cache.append(entry_json)
+        self._history_messages_cache.append(messages)
+        if self.manual_mode:
+            # Manual mode shows the history as a JSON list; one extra token for the separator between entries.
+            tokens = count_tokens(entry_json) + 1
+        else:
+            # Auto mode sends the chat messages; a few extra tokens cover each message's role framing.
+            # Adjacent user turns are later folded together, so this slightly overestimates.
+            tokens = sum(count_tokens(m["content"]) + MESSAGE_TOKEN_OVERHEAD for m in messages)
+        self._token_prefix.append(self._token_prefix[-1] + tokens)
+
+    @staticmethod
+    def _entry_messages(entry: HistoryItem) -> List[Dict[str, str]]:
+        """Converts a history entry into the chat messages that represent it."""
+        if isinstance(entry, SummaryEntry):
+            return [{"role": "user", "content": f"Summary of your earlier actions:\n{entry.content}"}]
+        if isinstance(entry, ErrorEntry):
+            return [{"role": "user", "content": entry.error}]
+        return [
+            {
+                "role": "assistant",
+                "content": msgspec.json.encode({"thoughts": entry.thoughts, "command": entry.command}).decode()
+            },
+            # Results are sent as user turns so the model replies to each one and roles alternate.
+            {"role": "user", "content": f"Result of `{entry.command.name}`:\n{entry.result}"},
+        ]
+
+    def _append_history(self, entry: HistoryItem):
+        """Appends an entry to the history, keeping the caches in step."""
+        self.state["history"].append(entry)
+        self._cache_entry(entry)
+
+    def _summary_count(self) -> int:
+        """Returns how many summary entries lead the history."""
+        history = self.state["history"]
+        count = 0
+        while count < len(history) and isinstance(history[count], SummaryEntry):
+            count += 1
+        return count
+
+    def _summarize(self, entries: List[HistoryItem]) -> Optional[str]:
+        """Asks the LLM to summarize entries; returns None if the LLM can't be reached."""
+        prompt = SUMMARY_PROMPT.format(steps=msgspec.json.encode(entries).decode())
+        try:
+            summary_text = query_llm([{"role": "user", "content": prompt}], model=LLM_MODEL)
+        except (requests.exceptions.RequestException, LLMServerError) as e:
+            print(f"History compaction failed, falling back to trimming: {e}")
+            return None
+        try:
+            summary = orjson.loads(summary_text)
+            if isinstance(summary, dict):
+                summary_text = str(summary.get("summary", summary_text))
+        except orjson.JSONDecodeError:
+            pass
+        return summary_text
+
+    def _compact_history(self):
+        """Folds the oldest history entries into a single LLM-written summary once the history outgrows the context window."""
+        history = self.state["history"]
+        if self.manual_mode or self._token_prefix[-1] <= CONTEXT_WINDOW_TOKEN_LIMIT:
+            return
+        # Summaries stay at the front and are always sent; once they outgrow their budget they are merged into one.
+        first = self._summary_count()
+        if first > 1 and self._token_prefix[first] > SUMMARY_TOKEN_BUDGET:
+            print(f"\n>> Merging {first} history summaries into one...")
+            start, end = 0, first
+        elif len(history) - first > COMPACT_BATCH_SIZE:
+            print(f"\n>> Compacting {COMPACT_BATCH_SIZE} oldest history entries into a summary...")
+            start, end = first, first + COMPACT_BATCH_SIZE
+        else:
+            return  # Too few entries left; the newest ones are always kept verbatim.
+
+        summary_text = self._summarize(history[start:end])
+        if summary_text is None:
+            return
+        # Persist the compacted history before adopting it, so memory and the database never disagree.
+        compacted = history[:start] + [SummaryEntry(content=summary_text)] + history[end:]
+        try:
+            self._rewrite_state(compacted)
+        except sqlite3.Error as e:
+            print(f"Could not save compacted history, keeping it uncompacted: {e}")
+            return
+        self.state["history"] = compacted
+        self._rebuild_caches()
+
+    def _kept_range(self) -> Tuple[int, int]:
+        """Returns (summary count, start) so that history[:summary count] + history[start:] fits the context window."""
+        # Summaries hold the earliest reasoning and plan, so they are always kept and only verbatim entries are trimmed.
+        summaries = self._summary_count()
+        budget = CONTEXT_WINDOW_TOKEN_LIMIT - self._token_prefix[summaries]
+        total = self._token_prefix[-1]
+        start = bisect_left(self._token_prefix, total - budget, lo=summaries)
+        # Always keep at least the newest entry, even if it alone exceeds the limit.
+        return summaries, min(start, max(len(self.state["history"]) - 1, summaries))
 
     def _construct_prompt(self) -> str:
         """Constructs the full prompt for the LLM, managing context window."""
-        full_history = self.state.get("history", [])
-        
-        history_str = json.dumps(full_history, indent=2)
-        while len(history_str) > CONTEXT_WINDOW_TOKEN_LIMIT and len(full_history) > 1:
-            full_history = full_history[1:]
-            history_str = json.dumps(full_history, indent=2)
-
-        prompt = SYSTEM_PROMPT.format(
-            main_goal=self.main_goal,
-            tools_description=self._get_tools_description()
-        )
-        prompt += f"\n\n**History (Your previous actions):**\n{history_str}"
-        return prompt
+        self._compact_history()
+        summaries, start = self._kept_range()
+        history_str = "[" + ",".join(self._history_json_cache[:summaries] + self._history_json_cache[start:]) + "]"
+        return "".join((self._system_prompt_prefix, "\n\n**History (Your previous actions):**\n", history_str))
+
+    def _construct_messages(self) -> List[Dict[str, str]]:
+        """Constructs the chat messages for the LLM, managing context window."""
+        # The system prompt and earlier turns are identical from one turn to the next,
+        # so the server can reuse its cached prefix and only prefill the newest turn.
+        self._compact_history()
+        messages = [{"role": "system", "content": self._system_prompt_prefix}, self._opening_message]
+        summaries, start = self._kept_range()
+        for entry_messages in self._history_messages_cache[:summaries] + self._history_messages_cache[start:]:
+            for message in entry_messages:
+                # Errors and summaries are user turns too; fold adjacent ones together so roles strictly alternate.
+                if message["role"] == "user" and messages[-1]["role"] == "user":
+                    messages[-1] = {"role": "user", "content": f"{messages[-1]['content']}\n\n{message['content']}"}
+                else:
+                    messages.append(message)
+        return messages
 
     def run(self):
         """The main execution loop of the agent."""
         while True:
-            prompt = self._construct_prompt()
-
             print("\n==================== PROMPT TO LLM ====================")
             print(f"Goal: {self.main_goal}")
 
@@ -190,7 +598,7 @@ class Agent:
                     print("The prompt that would be sent to the LLM is printed below.")
                     print("Copy it, generate a response, and paste the raw JSON back here.")
                     print("------------------------------------------------------------")
-                    print(prompt)
+                    print(self._construct_prompt())
                     print("------------------------------------------------------------")
                     print("Paste the LLM's JSON response below. Press Ctrl+D (Unix) or Ctrl+Z+Enter (Windows) when done:")
                     llm_response_text = sys.stdin.read()
@@ -200,10 +608,10 @@ class Agent:
                     print("\n--- Input received, processing... ---")
                 else:
                     print("Requesting next action from LLM...")
-                    llm_response_text = query_llm(prompt, model=LLM_MODEL, history=self.state['history'])
+                    llm_response_text = query_llm(self._construct_messages(), model=LLM_MODEL, echo=True)
                 # <--- END MODIFICATION
 
-                response_json = json.loads(llm_response_text)
+                response_json = orjson.loads(llm_response_text)
 
                 thoughts = response_json.get("thoughts", "")
                 command_spec = response_json.get("command", {})
@@ -227,48 +635,168 @@ class Agent:
                 
                 print(f"\nCOMMAND RESULT:\n---\n{result}\n---")
 
-                self.state["history"].append({
-                    "thoughts": thoughts,
-                    "command": command_spec,
-                    "result": result
-                })
+                self._append_history(HistoryEntry(
+                    thoughts=str(thoughts),
+                    command=CommandSpec(
+                        name=None if command_name is None else str(command_name),
+                        args=command_args if isinstance(command_args, dict) else {}
+                    ),
+                    result=str(result)
+                ))
                 self._save_state()
 
-            except json.JSONDecodeError:
+            except json.JSONDecodeError:  # Also catches orjson.JSONDecodeError, a subclass
                 error_msg = f"Error: LLM did not return valid JSON. Response:\n{llm_response_text}"
                 print(error_msg)
-                self.state["history"].append({"error": error_msg})
+                if not self.manual_mode:
+                    print(f"(If the response looks cut off, raise LLM_MAX_TOKENS; it is currently {LLM_MAX_TOKENS}.)")
+                self._append_history(ErrorEntry(error=error_msg))
                 self._save_state()
             except requests.exceptions.RequestException as e:
-                error_msg = f"Error: Could not connect to LLM API at {LLM_API_URL}. Is it running? Details: {e}"
+                error_msg = f"Error: Could not connect to LLM API at {_BACKEND.url}. Is it running? Details: {e}"
                 print(error_msg)
                 sys.exit(1)
+            except LLMServerError as e:
+                print(f"Error: The LLM server at {_BACKEND.url} returned an error. Details: {e}")
+                sys.exit(1)
             except KeyboardInterrupt:
                 print("\n\nUser interrupted. Saving state and exiting.")
                 self._save_state()
+                self._db.close()
+                _SESSION.close()
                 sys.exit(0)
             except Exception as e:
                 error_msg = f"An unexpected error occurred: {e}"
                 print(error_msg)
-                self.state["history"].append({"error": error_msg})
+                self._append_history(ErrorEntry(error=error_msg))
                 self._save_state()
 
 
-def query_llm(prompt: str, model: str, history: List[Dict]) -> str:
-    """Sends a query to the local LLM API."""
-    payload = {
-        "model": model,
-        "prompt": prompt,
-        "stream": False,
-        "format": "json",
-        "options": {
+# --- LLM Backends ---
+
+class LLMServerError(RuntimeError):
+    """The LLM server answered, but with an error instead of a reply."""
+
+
+class LLMBackend(ABC):
+    """Base class for an LLM server. Subclasses describe its request and response formats."""
+    url = ""
+
+    @abstractmethod
+    def build_payload(self, messages: List[Dict[str, str]], model: str, stream: bool) -> Dict[str, Any]:
+        """Builds the request body for a chat completion."""
+
+    @abstractmethod
+    def parse_chunk(self, line: bytes) -> Tuple[str, bool]:
+        """Parses one line of a streamed response into (token, done)."""
+
+    @abstractmethod
+    def parse_response(self, data: Dict[str, Any]) -> str:
+        """Extracts the reply text from a non-streamed response."""
+
+    def generate(self, messages: List[Dict[str, str]], model: str, echo: bool = False) -> str:
+        """Streams a reply and returns the full text; with `echo`, tokens are printed as they arrive."""
+        payload = self.build_payload(messages, model, stream=True)
+        parts = []
+        with _SESSION.post(self.url, json=payload, timeout=300, stream=payload.get("stream", False)) as response:
+            response.raise_for_status()
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                token, done = self.parse_chunk(line)
+                if echo:
+                    print(token, end="", flush=True)
+                parts.append(token)
+                if done:
+                    break
+        if echo:
+            print()
+        return "".join(parts).strip()
+
+    async def agenerate(self, client: "httpx.AsyncClient", messages: List[Dict[str, str]], model: str) -> str:
+        """Sends a single non-streaming request over an async client."""
+        response = await client.post(self.url, json=self.build_payload(messages, model, stream=False))
+        response.raise_for_status()
+        return self.parse_response(orjson.loads(response.content)).strip()
+
+
+class OllamaBackend(LLMBackend):
+    """Ollama's native /api/chat endpoint."""
+    url = LLM_API_URL
+
+    def build_payload(self, messages: List[Dict[str, str]], model: str, stream: bool) -> Dict[str, Any]:
+        # num_keep pins the system prompt in the KV cache so it is not re-evaluated each turn.
+        num_keep = _approx_tokens(messages[0]["content"]) if messages and messages[0]["role"] == "system" else 0
+        return {
+            "model": model,
+            "messages": messages,
+            "stream": stream,
+            "format": "json",
+            "options": {
+                "temperature": 0.7,
+                "num_ctx": OLLAMA_NUM_CTX,
+                "num_keep": num_keep,
+                "num_predict": LLM_MAX_TOKENS,
+            }
+        }
+
+    def parse_chunk(self, line: bytes) -> Tuple[str, bool]:
+        # Ollama streams one JSON object per line; a failure mid-stream arrives as {"error": ...}.
+        chunk = orjson.loads(line)
+        if chunk.get("error"):
+            raise LLMServerError(f"Ollama error: {chunk['error']}")
+        return chunk.get("message", {}).get("content", ""), bool(chunk.get("done"))
+
+    def parse_response(self, data: Dict[str, Any]) -> str:
+        if data.get("error"):
+            raise LLMServerError(f"Ollama error: {data['error']}")
+        return data.get("message", {}).get("content", "")
+
+
+class VLLMBackend(LLMBackend):
+    """vLLM's OpenAI-compatible /v1/chat/completions endpoint."""
+    url = VLLM_API_URL
+
+    def build_payload(self, messages: List[Dict[str, str]], model: str, stream: bool) -> Dict[str, Any]:
+        return {
+            "model": model,
+            "messages": messages,
+            "stream": stream,
+            "response_format": {"type": "json_object"},
             "temperature": 0.7,
+            "max_tokens": LLM_MAX_TOKENS,
         }
-    }
-    response = requests.post(LLM_API_URL, json=payload, timeout=300)
-    response.raise_for_status()
-    response_data = response.json()
-    return response_data.get("response", "").strip()
+
+    def parse_chunk(self, line: bytes) -> Tuple[str, bool]:
+        # Server-sent events: "data: {...}" lines, terminated by "data: [DONE]".
+        if not line.startswith(b"data:"):
+            return "", False
+        data = line[len(b"data:"):].strip()
+        if data == b"[DONE]":
+            return "", True
+        chunk = orjson.loads(data)
+        if chunk.get("error"):
+            raise LLMServerError(f"vLLM error: {chunk['error']}")
+        choices = chunk.get("choices") or [{}]
+        return choices[0].get("delta", {}).get("content") or "", False
+
+    def parse_response(self, data: Dict[str, Any]) -> str:
+        if data.get("error"):
+            raise LLMServerError(f"vLLM error: {data['error']}")
+        choices = data.get("choices") or [{}]
+        return choices[0].get("message", {}).get("content") or ""
+
+
+BACKENDS = {
+    "ollama": OllamaBackend,
+    "vllm": VLLMBackend,
+}
+_BACKEND: LLMBackend = OllamaBackend()  # Replaced in main() according to LLM_BACKEND
+
+
+def query_llm(messages: List[Dict[str, str]], model: str, echo: bool = False) -> str:
+    """Sends a chat query to the configured LLM backend, optionally printing the reply as it streams."""
+    return _BACKEND.generate(messages, model, echo=echo)
 
 
 def main():
@@ -287,6 +815,12 @@ def main():
     )
     args = parser.parse_args()
 
+    global _BACKEND
+    backend_name = os.environ.get("LLM_BACKEND", "ollama")
+    if backend_name not in BACKENDS:
+        parser.error(f"Unknown LLM_BACKEND '{backend_name}'. Choose one of: {', '.join(BACKENDS)}.")
+    _BACKEND = BACKENDS[backend_name]()
+
     # <--- MODIFIED: Pass manual flag to agent
     agent = Agent(main_goal=args.goal, manual_mode=args.manual)
     if args.manual: